@@ -1,8 +1,11 @@
-import numpy as np
 import pandas as pd
+import json
+import functools
 from time import sleep
 
 import dash
+import diskcache
+from dash import DiskcacheManager
 from dash.exceptions import PreventUpdate
 from dash.dependencies import Input, Output, State
 from dash import html
@@ -13,7 +16,6 @@ import plotly.express as px
 import plotly.tools
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-from PIL import Image
 
 import dash_canvas
 from dash_canvas.components import image_upload_zone
@@ -27,17 +29,26 @@ from dash_canvas.utils import (
 import pathlib
 import utils as vru
 
+# get relative data folder
+PATH = pathlib.Path(__file__).parent
+
+#Simulations run as background jobs in their own processes, queued through a local disk cache
+background_callback_manager = DiskcacheManager(diskcache.Cache(str(PATH.joinpath("jobs"))))
+
 app = dash.Dash(
-    __name__, meta_tags=[{"name": "viewport", "content": "width=device-width"}]
+    __name__, meta_tags=[{"name": "viewport", "content": "width=device-width"}],
+    background_callback_manager=background_callback_manager,
 )
 server = app.server
 app.config.suppress_callback_exceptions = True
 
-# get relative data folder
-PATH = pathlib.Path(__file__).parent
-
 DATA_PATH = PATH.joinpath("data").resolve()
 
+#Finished runs are cached on disk and shared by all the gunicorn workers. The seed is fixed so
+#the same inputs always give the same run and hit the cache
+result_cache = vru.ResultCache(PATH.joinpath("cache"))
+SIM_SEED = 0
+
 table_header_style = {
     "backgroundColor": "rgb(2,21,70)",
     "color": "white",
@@ -373,7 +384,7 @@ app.layout = html.Div(
                 ),
                 html.Div(
                     [
-                        html.Label("Fraction of specialist radiologists to non-specialists)", style={'margin-bottom': '10px', 'margin-top': '45px', 'margin-right':'15px'}),
+                        html.Label("Fraction of specialist radiologists (the rest read every image type)", style={'margin-bottom': '10px', 'margin-top': '45px', 'margin-right':'15px'}),
                         html.Div(
                             [
                                 dcc.Slider(
@@ -430,6 +441,13 @@ app.layout = html.Div(
                 html.Button(
                     "Run Simulation", id="button-run-sim", className="button_submit", style={"margin-top": "50px", "margin-left": "110px"},
                 ),
+                html.Div(
+                    [
+                        html.Progress(id="sim-progress", value="0", max="100", style={"width": "100%"}),
+                        html.P(id="sim-progress-label"),
+                    ],
+                    style={"margin-top": "15px", "margin-left": "15px", "margin-right": "15px"},
+                ),
             ],
             className="four columns instruction",
         ),
@@ -528,10 +546,18 @@ app.layout = html.Div(
                             "backgroundColor": "white",
                         },
                     ],
+                    page_current=0,
                     page_size=10,
-                    page_action='none',
-                    style_table={'width':'80%', 'horizontalAlign':'middle', 'margin-left': 50, 'height': '300px', 'overflowY': 'auto'},
+                    page_action='custom',
+                    sort_action='custom',
+                    sort_mode='multi',
+                    sort_by=[],
+                    filter_action='custom',
+                    filter_query='',
+                    style_table={'width':'80%', 'horizontalAlign':'middle', 'margin-left': 50, 'overflowY': 'auto'},
                 ),
+                #SimConfig arguments of the run shown in the table, its rows are read back from the result cache
+                dcc.Store(id="results-run"),
                              
             ],
         ),
@@ -577,7 +603,8 @@ def update_graph(
                 Output("targ-rate-2-o", "children"),
                 Output("targ-rate-3-o", "children"),
                 Output("results-table", "columns"),
-                Output("results-table", "data"),
+                Output("results-run", "data"),
+                Output("results-table", "page_current"),
                 Output("results-graph", "figure"),
                 Output('idl-plot', 'figure'),   
                 Output('busy-plot', 'figure'),      
@@ -599,22 +626,33 @@ def update_graph(
                 State("percent-special", "value"),
                 State("verbose-val", "value")
             ],
+            background=True,
+            progress=[Output("sim-progress", "value"), Output("sim-progress", "max"), Output("sim-progress-label", "children")],
+            running=[(Output("button-run-sim", "children"), "Restart Simulation", "Run Simulation")],
+            prevent_initial_call=True,
             )
-def update_simulation(n_cl, sim_duration, num_rads, arr_rate_1, arr_rate_2, arr_rate_3, 
+def update_simulation(set_progress, n_cl, sim_duration, num_rads, arr_rate_1, arr_rate_2, arr_rate_3, 
                             proc_rate_1, proc_rate_2, proc_rate_3, targ_rate_1, targ_rate_2, targ_rate_3, 
                             cutoff_val, perc_special, verb_val):
-    verbose = 0
-    if verb_val is not None:
-        verbose = 1 
+    #Clicking again while a run is in flight makes dash terminate the old job before starting this one
+    if n_cl in [0, None]:
+        raise PreventUpdate
     sim_duration = sim_duration * 60
     arr_rates = [arr_rate_1, arr_rate_2, arr_rate_3]
     proc_rates = [proc_rate_1, proc_rate_2, proc_rate_3]
     targ_rates = [targ_rate_1, targ_rate_2, targ_rate_3]
-    sys_state = vru.sim(sim_duration, num_rads, arr_rates, proc_rates, constant_rads=False, cutoff=cutoff_val, verbose=verb_val)
+    run = dict(sim_time=sim_duration, num_rads=num_rads, arr_times=arr_rates, proc_times=proc_rates, targ_times=targ_rates,
+               cutoff=float(cutoff_val), perc_special=perc_special)
+    config = vru.SimConfig(**run)
+    end_time = sim_duration * config.cutoff
+    def report(s):
+        set_progress((str(min(s.time, end_time)), str(end_time), f"{s.time:.0f} of {end_time:.0f} simulated minutes, {s.next_arrival} images arrived, {len(s.completed)} read"))
+    sys_state = vru.cached_run(config, SIM_SEED, result_cache, verbose=bool(verb_val), progress=report)
+    set_progress((str(end_time), str(end_time), f"Done, {len(sys_state.img_table)} images read"))
     img_table = sys_state.img_table
     img_table['urgency'] = img_table['urgency'].astype(int).astype(str)
     list_columns = ['img_id','urgency', 'rad_id', 'time_created','time_rad_job_starts', 'time_job_finished', 'wait_time', 'time_w_rad', 'total_time']
-    columns = [{"name": i, "id": i} for i in list_columns]
+    columns = [{"name": i, "id": i, "type": "numeric"} for i in list_columns]
     simulation_params = {'Simulation Duration': sim_duration, 'Num Radiologists': num_rads, 'Avg Time between Images':arr_rates, 'Avg Time to be processed once seen': proc_rates, 'Time Limit': targ_rates}
     #Make figure
     fig = px.scatter(img_table, x="time_created", y="total_time", title="Image Processing Times",
@@ -627,39 +665,11 @@ def update_simulation(n_cl, sim_duration, num_rads, arr_rate_1, arr_rate_2, arr_
                             hover_name="img_id",
                             log_x=False, size_max=60)
     
-    total_per_busy = vru.idle_plots(sys_state.rads)
-    image_path = 'figures/idle_plot.jpg'
-    #html.Img(src="figures/idle_plot.jpg"),
-    #plt.show()
-    try:
-        idle_img = np.array(Image.open(f"figures/idle_plot.jpg"))
-        busy_img = np.array(Image.open(f"figures/busy_plot.jpg"))
-    except OSError:
-        raise PreventUpdate
-
-    idl_fig = px.imshow(idle_img, color_continuous_scale="gray", title="Busy vs Idle Times for Radiologists", aspect="auto", width=1200, height=900)
-    idl_fig.update_layout(coloraxis_showscale=False)
-    idl_fig.update_xaxes(showticklabels=False)
-    idl_fig.update_yaxes(showticklabels=False)
-    idl_fig.update_traces(hovertemplate = None,
-                  hoverinfo = "skip")
-    
-    busy_fig = px.imshow(busy_img, color_continuous_scale="gray", title="Percentage of Time Busy for Radiologists", aspect="auto", width=1000, height=1000)
-    busy_fig.update_layout(coloraxis_showscale=False)
-    busy_fig.update_xaxes(showticklabels=False)
-    busy_fig.update_yaxes(showticklabels=False)
-    busy_fig.update_traces(hovertemplate = None,
-                  hoverinfo = "skip")
-
-    
+    total_per_busy, idl_fig, busy_fig = vru.idle_plots(sys_state.intervals)
 
     #wt_plot_url = py.plot_mpl(wt_plot, filename="wait_time_plot")
     
-
-    if n_cl in [0, None]:
-            raise PreventUpdate
-    else:
-        return sim_duration, num_rads, u'Urgency 1: {} mins'.format(arr_rate_1), u'Urgency 2: {} mins'.format(arr_rate_2), u'Urgency 3: {} mins'.format(arr_rate_3), u'Urgency 1: {} mins'.format(proc_rate_1), u'Urgency 2: {} mins'.format(proc_rate_2), u'Urgency 3: {} mins'.format(proc_rate_3), u'Urgency 1: {} mins'.format(targ_rate_1), u'Urgency 2: {} mins'.format(targ_rate_2), u'Urgency 3: {} mins'.format(targ_rate_3), columns, img_table.round(2).to_dict('records'), fig, idl_fig, busy_fig #app.get_asset_url(image_path)  
+    return sim_duration, num_rads, u'Urgency 1: {} mins'.format(arr_rate_1), u'Urgency 2: {} mins'.format(arr_rate_2), u'Urgency 3: {} mins'.format(arr_rate_3), u'Urgency 1: {} mins'.format(proc_rate_1), u'Urgency 2: {} mins'.format(proc_rate_2), u'Urgency 3: {} mins'.format(proc_rate_3), u'Urgency 1: {} mins'.format(targ_rate_1), u'Urgency 2: {} mins'.format(targ_rate_2), u'Urgency 3: {} mins'.format(targ_rate_3), columns, run, 0, fig, idl_fig, busy_fig  
 
     """""
     simulation_parameters.sim_duration = sim_dur
@@ -677,6 +687,88 @@ def update_simulation(n_cl, sim_duration, num_rads, arr_rate_1, arr_rate_2, arr_
 
 
 
+@functools.lru_cache(maxsize=2)
+def load_img_table(run_key):
+    #Completed images of a run from the result cache, kept in memory while its table is being paged through.
+    #Never simulates, that only happens in the background callback. KeyError if the run was evicted, errors aren't cached
+    #by lru_cache so the table loads again once the run is redone
+    result = result_cache.get(vru.SimConfig(**json.loads(run_key)), SIM_SEED)
+    if result is None:
+        raise KeyError(run_key)
+    return result.img_table
+
+
+FILTER_OPERATORS = [['ge ', '>='], ['le ', '<='], ['lt ', '<'], ['gt ', '>'], ['ne ', '!='], ['eq ', '='], ['contains '], ['datestartswith ']]
+
+
+def split_filter_part(filter_part):
+    #"{column} op value" from a DataTable filter_query -> (column, op, value)
+    for operator_type in FILTER_OPERATORS:
+        for operator in operator_type:
+            if operator in filter_part:
+                name_part, value_part = filter_part.split(operator, 1)
+                name = name_part[name_part.find('{') + 1: name_part.rfind('}')]
+                value_part = value_part.strip()
+                v0 = value_part[:1]
+                if v0 and v0 == value_part[-1] and v0 in ("'", '"', '`'):
+                    value = value_part[1: -1].replace('\\' + v0, v0)
+                else:
+                    try:
+                        value = float(value_part)
+                    except ValueError:
+                        value = value_part
+                return name, operator_type[0].strip(), value
+    return [None] * 3
+
+
+def filter_table(table, filter_query):
+    for filter_part in filter_query.split(' && '):
+        col_name, operator, filter_value = split_filter_part(filter_part)
+        if col_name not in table.columns:
+            continue
+        try:
+            if operator in ('eq', 'ne', 'lt', 'le', 'gt', 'ge'):
+                table = table.loc[getattr(table[col_name], operator)(filter_value)]
+            elif operator == 'contains':
+                table = table.loc[table[col_name].astype(str).str.contains(str(filter_value), regex=False)]
+            elif operator == 'datestartswith':
+                table = table.loc[table[col_name].astype(str).str.startswith(str(filter_value))]
+        except TypeError:
+            table = table.iloc[:0]
+    return table
+
+
+@app.callback(
+            [
+                Output("results-table", "data"),
+                Output("results-table", "page_count"),
+            ],
+            [
+                Input("results-table", "page_current"),
+                Input("results-table", "page_size"),
+                Input("results-table", "sort_by"),
+                Input("results-table", "filter_query"),
+                Input("results-run", "data"),
+            ],
+            prevent_initial_call=True,
+            )
+def update_results_table(page_current, page_size, sort_by, filter_query, run):
+    #Filters, sorts and pages the run's table on the server so only the visible rows are sent
+    if run is None:
+        raise PreventUpdate
+    try:
+        img_table = load_img_table(json.dumps(run, sort_keys=True))
+    except KeyError:
+        #evicted from the result cache, empty until the simulation is run again
+        return [], 1
+    img_table = filter_table(img_table, filter_query or '')
+    if sort_by:
+        img_table = img_table.sort_values([col['column_id'] for col in sort_by],
+                                          ascending=[col['direction'] == 'asc' for col in sort_by], kind='stable')
+    page = img_table.iloc[page_current * page_size:(page_current + 1) * page_size]
+    page_count = max(1, -(-len(img_table) // page_size))
+    return page.round(2).to_dict('records'), page_count
+
 
 @app.callback(Output("upload-table", "contents"), [Input("demo", "n_clicks")])
 def reset_contents(n_clicks):
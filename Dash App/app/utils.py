@@ -1,15 +1,30 @@
-import random
 import datetime
+import heapq
+import itertools
+import bisect
+import os
+import io
+import contextlib
+import json
+import hashlib
+import tempfile
+import pickle
+import zlib
+from operator import attrgetter
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from collections import deque
+from dataclasses import dataclass, fields, replace
+from types import SimpleNamespace
 import numpy as np
 import pandas as pd
 import matplotlib.pyplot as plt
 import matplotlib.patches as mpatches
-import sys
+from scipy import stats
 import plotly as py
 import plotly.tools
+import plotly.graph_objects as go
 import matplotlib
 matplotlib.use('agg')
-sys.setrecursionlimit(10000)
 
 
 class G:
@@ -23,15 +38,22 @@ G.target_times = {
     3: 5
 }
 
+    
+#Bump when a change to the engine changes the results of a seeded run, so cached results are not reused
+ENGINE_VERSION = 3
+
+
+#Event kinds, SystemState.handlers is indexed by these codes and register_event adds new ones
+NEW_JOB = 0
+JOB_DONE = 1
+SIM_END = 2
+SHIFT_START = 3
+SHIFT_END = 4
+JOB_STARTED = 5    #only written to the event history, never scheduled
+DEADLINE_MISS = 6    #fired from SystemState.deadlines rather than the event heap
+EVENT_NAMES = ["New Job", "Job Done", "Sim End", "Shift Start", "Shift End", "Job Started", "Deadline Miss"]
 
-def update_target_times(target_times):
-    G.target_times = {
-        1: target_times[0],
-        2: target_times[1],
-        3: target_times[2]
-    }
 
-    
 G.specialties = {
     1: '1',
     2: '2',
@@ -41,165 +63,361 @@ G.specialties = {
 }
 
 
-def update_globals(urg_times):
-    G.process_times = {
-                        1: urg_times[0],
-                        2: urg_times[1],
-                        3: urg_times[2]
-                    }    
-    
-
-def create_arrival_times(sim_time, arr_rates):  #[time_between_urg 1 images, etc..]
+def create_arrival_times(sim_time, arr_rates, rng=None):  #[time_between_urg 1 images, etc..]
+    if rng is None:
+        rng = np.random.default_rng()
     arrival_times_dict = {}
-    arrival_times_tuples_list = []
-    #Create arrival times for each urgency of images
-    urg = 1
-    for arr_time in arr_rates:
-        arrival_times = []
-        time = 0
-        while time < sim_time:
-            time += np.random.exponential(arr_time)
-            arrival_times.append(time)
-            arrival_times_tuples_list.append([urg, time])
-        arrival_times_dict[urg] = arrival_times
-        urg += 1
-    arrival_times_tuples_list = sorted(arrival_times_tuples_list, key=lambda x: x[1])
-    return arrival_times_dict, arrival_times_tuples_list
-
-
-def create_medical_images(arrival_times_tuples_list):
-    med_images = []
-    for img_id, tup in enumerate(arrival_times_tuples_list):
-        med_images.append(MedicalImage(img_id, tup[1], tup[0], random.sample(list(G.specialties.keys()), 1)[0]))
+    #Create arrival times for each urgency of images, drawing the gaps in blocks
+    for urg, arr_time in enumerate(arr_rates, start=1):
+        block = int(sim_time / arr_time) + 16
+        arrival_times = np.cumsum(rng.exponential(arr_time, block))
+        while arrival_times[-1] < sim_time:
+            more = arrival_times[-1] + np.cumsum(rng.exponential(arr_time, block))
+            arrival_times = np.concatenate([arrival_times, more])
+        #keep everything up to and including the first arrival at or past sim_time
+        arrival_times_dict[urg] = arrival_times[:np.searchsorted(arrival_times, sim_time) + 1]
+    arrival_times = np.concatenate(list(arrival_times_dict.values()))
+    urgencies = np.concatenate([np.full(len(times), urg, dtype=np.int8) for urg, times in arrival_times_dict.items()])
+    order = np.argsort(arrival_times, kind='stable')
+    return arrival_times_dict, arrival_times[order], urgencies[order]
+
+
+def create_medical_images(config, arrival_times, urgencies, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
+    image_types = rng.choice(np.array(config.specialties), len(arrival_times))
+    med_images = ImageStore(arrival_times, urgencies, image_types, config.target_times, config.process_times)
     print(f"{len(med_images)} medical images")
     return med_images
 
 
-def create_constant_rads(num_rads):
+def random_specialties(rng, specialties=tuple(G.specialties)):
+    return rng.choice(list(specialties), rng.integers(2, len(specialties)), replace=False).tolist()
+
+
+def create_constant_rads(num_rads, rng=None, specialties=tuple(G.specialties)):
+    #fixed specialties to pass as SimConfig(constant_rads=...), so every run uses the same radiologists
+    if rng is None:
+        rng = np.random.default_rng()
     specialties_list = []
     for i in range(num_rads):
-        specialties_list.append(random.sample(list(G.specialties.keys()), random.randrange(2,len(G.specialties))))
-    G.const_specialities = specialties_list
+        specialties_list.append(tuple(random_specialties(rng, specialties)))
+    return tuple(specialties_list)
 
     
-def create_radiologists(num_rads, constant_rads):
+def create_radiologists(config, rng=None):
+    if rng is None:
+        rng = np.random.default_rng()
     radiologists = []
-    for i in range(num_rads):
-        if constant_rads:
-            specialties_temp = G.const_specialities[i] 
+    num_special = round(config.perc_special * config.num_rads)
+    for i in range(config.num_rads):
+        if config.constant_rads:
+            specialties_temp = list(config.constant_rads[i])
+        elif i < num_special:
+            specialties_temp = random_specialties(rng, config.specialties)
         else:
-            specialties_temp = random.sample(list(G.specialties.keys()), random.randrange(2,len(G.specialties)))
+            #generalists read every image type
+            specialties_temp = list(config.specialties)
         radiologists.append(Radiologist(i, specialties_temp))
     return radiologists
 
 
 def create_initial_events(sim_duration, med_images, cutoff=False):
-    events=[]
-    for img in med_images:
-        events.append([img.time_created, 'New Job', img])
+    #events are (time, seq, kind, obj), seq breaks ties between events at the same time.
+    #Arrivals are read straight from the med_images table by SystemState, so they are not queued here
+    #cutoff is the multiple of sim_duration to stop at, True stops at twice sim_duration
+    events = []
     if cutoff:
-        events.append([sim_duration*2, "Sim End"])
-    events = sorted(events, key=lambda x: x[0])
+        events.append((sim_duration * (2 if cutoff is True else cutoff), 0, SIM_END, None))
     return events
 
 
-def start_simulation(events, med_images, radiologists, constant_rads, cutoff=False):
-    s = SystemState(events, med_images, G.radiologists, cutoff)
-    s.run_simulation()
-
-
 class MedicalImage(object):    
-    def __init__(self, img_id, time_created, urgency, image_type):#, modality, speciality, urgency, image_label):
+    #Snapshot of one image's row in an ImageStore, the simulation itself only passes img_ids around
+    __slots__ = ['img_id', 'time_created', 'urgency', 'image_type', 'target_time', 'deadline', 'est_process_time', 'time_seen', 'time_done', 'rad_seen']
+
+    def __init__(self, img_id, time_created, urgency, image_type, target_time, est_process_time):#, modality, speciality, urgency, image_label):
         self.img_id = img_id
         self.time_created = time_created
         self.urgency = urgency
         self.image_type = image_type
-        self.target_time = G.target_times[urgency]
-        self.time_remaining = G.target_times[urgency]
-        self.est_process_time = G.process_times[urgency]
-        self.in_queues = []   #keep track on which queues image is in [rad_id, position]
+        self.target_time = target_time
+        self.deadline = time_created + self.target_time
+        self.est_process_time = est_process_time
         self.time_seen = 0
         self.time_done = 0
         self.rad_seen = "None"
         
-    def update_time_remaining(self, t):
-        self.time_remaining = self.target_time - (t - self.time_created)
+    def time_remaining(self, t):
+        return self.deadline - t
+        
+        
+class ImageStore:
+    #Struct-of-arrays record of every image, indexed by img_id and sorted by arrival time.
+    #time_seen, time_done and rad_seen are filled in as the simulation runs
+    def __init__(self, time_created, urgency, image_type, target_times, process_times):
+        n = len(time_created)
+        self.time_created = np.asarray(time_created, dtype=np.float64)
+        self.urgency = np.asarray(urgency, dtype=np.int8)
+        self.image_type = np.asarray(image_type, dtype=np.int16)
+        self.time_seen = np.full(n, np.nan)
+        self.time_done = np.full(n, np.nan)
+        self.rad_seen = np.full(n, -1, dtype=np.int32)    #-1 until a radiologist starts reading the image
+        self.target_times = dict(target_times)
+        self.process_times = dict(process_times)
+        self.time_due = self.due_times()
+
+    def __len__(self):
+        return len(self.time_created)
+
+    def due_times(self):
+        targets = np.zeros(max(self.target_times, default=0) + 1)
+        targets[list(self.target_times)] = list(self.target_times.values())
+        return self.time_created + targets[self.urgency]
+
+    def replace_future(self, start, time_created, urgency, image_type):
+        #drops the images from img_id start on, which must not have arrived yet, and appends new ones in their place
+        n = len(time_created)
+        self.time_created = np.concatenate([self.time_created[:start], np.asarray(time_created, dtype=np.float64)])
+        self.urgency = np.concatenate([self.urgency[:start], np.asarray(urgency, dtype=np.int8)])
+        self.image_type = np.concatenate([self.image_type[:start], np.asarray(image_type, dtype=np.int16)])
+        self.time_seen = np.concatenate([self.time_seen[:start], np.full(n, np.nan)])
+        self.time_done = np.concatenate([self.time_done[:start], np.full(n, np.nan)])
+        self.rad_seen = np.concatenate([self.rad_seen[:start], np.full(n, -1, dtype=np.int32)])
+        self.time_due = self.due_times()
+
+    def deadline(self, img_id):
+        return float(self.time_due[img_id])
+
+    def image(self, img_id):
+        urgency = int(self.urgency[img_id])
+        med_image = MedicalImage(img_id, float(self.time_created[img_id]), urgency, int(self.image_type[img_id]), self.target_times[urgency], self.process_times[urgency])
+        if self.rad_seen[img_id] >= 0:
+            med_image.rad_seen = int(self.rad_seen[img_id])
+            med_image.time_seen = float(self.time_seen[img_id])
+        if not np.isnan(self.time_done[img_id]):
+            med_image.time_done = float(self.time_done[img_id])
+        return med_image
+        
+        
+class ServiceSampler:
+    #Hands out service times one at a time from large blocks drawn with a numpy Generator.
+    #Subclasses only implement draw(size), any distribution gets the same batched fast path
+    block_size = 4096
+
+    def __init__(self, mean, rng):
+        self.mean = mean
+        self.rng = rng
+        self.block = []
+        self.pos = 0
+
+    def reset(self, rng):
+        #switch to another Generator, dropping what is left of the current block
+        self.rng = rng
+        self.block = []
+        self.pos = 0
+
+    def draw(self, size):
+        raise NotImplementedError
+
+    def __call__(self):
+        if self.pos == len(self.block):
+            self.block = self.draw(self.block_size).tolist()
+            self.pos = 0
+        value = self.block[self.pos]
+        self.pos += 1
+        return value
+
+
+class UniformSampler(ServiceSampler):
+    #uniform [0, mean) values, used for random dispatch choices
+    def draw(self, size):
+        return self.rng.random(size) * self.mean
+
+
+class ExponentialSampler(ServiceSampler):
+    def draw(self, size):
+        return self.rng.exponential(self.mean, size)
+
+
+class LognormalSampler(ServiceSampler):
+    #sigma is the standard deviation of the log service time, mu is set so the mean matches
+    def __init__(self, mean, rng, sigma=0.5):
+        super().__init__(mean, rng)
+        self.sigma = sigma
+        self.mu = np.log(mean) - sigma**2 / 2
+
+    def draw(self, size):
+        return self.rng.lognormal(self.mu, self.sigma, size)
+
+
+class GammaSampler(ServiceSampler):
+    def __init__(self, mean, rng, shape=2.0):
+        super().__init__(mean, rng)
+        self.shape = shape
+
+    def draw(self, size):
+        return self.rng.gamma(self.shape, self.mean / self.shape, size)
+
+
+class EmpiricalSampler(ServiceSampler):
+    #resamples observed service times, rescaled so their mean matches
+    def __init__(self, mean, rng, samples=None):
+        super().__init__(mean, rng)
+        if samples is None or len(samples) == 0:
+            raise ValueError("EmpiricalSampler needs observed service times, e.g. SimConfig(..., service_params={'samples': times})")
+        samples = np.asarray(samples, dtype=float)
+        self.samples = samples * (mean / samples.mean())
+
+    def draw(self, size):
+        return self.rng.choice(self.samples, size)
+
+
+#'broadcast' queues a copy with every capable radiologist, 'top_k' with the fanout_k capable radiologists
+#with the least work queued, 'power_of_d' with the least loaded of fanout_k picked at random
+FANOUTS = ('broadcast', 'top_k', 'power_of_d')
+
+
+@dataclass(frozen=True)
+class SimConfig:
+    #Everything that defines one simulated system. Runs only read their own config and never G,
+    #so several simulations can run at once in threads. Lists are stored as tuples
+    sim_time: float
+    num_rads: int
+    arr_times: tuple    #mean time between arrivals of urgency 1, 2, 3 images
+    proc_times: tuple    #mean reading time of urgency 1, 2, 3 images
+    targ_times: tuple    #target turnaround of urgency 1, 2, 3 images
+    constant_rads: tuple = ()    #specialties of each radiologist from create_constant_rads, empty to draw them at random
+    cutoff: float = False    #stop at this multiple of sim_time, True for 2, False to run until every image is read
+    perc_special: float = 1.0    #fraction of radiologists with a random subset of specialties, the rest read everything
+    specialties: tuple = tuple(G.specialties)
+    service_sampler: type = ExponentialSampler
+    miss_budget: int = None    #stop as soon as more than this many images have missed their target time
+    fanout: str = 'broadcast'    #which capable radiologists get a copy of an image, see FANOUTS
+    fanout_k: int = 3    #copies for 'top_k', radiologists sampled for 'power_of_d'
+    service_params: tuple = ()    #extra keyword arguments of service_sampler, e.g. {'sigma': 1.0}, stored as sorted (name, value) pairs
+
+    def __post_init__(self):
+        if self.fanout not in FANOUTS:
+            raise ValueError(f"fanout must be one of {FANOUTS}, not {self.fanout!r}")
+        if self.fanout_k < 1:
+            raise ValueError(f"fanout_k must be at least 1, not {self.fanout_k!r}")
+        for name in ('arr_times', 'proc_times', 'targ_times', 'specialties'):
+            object.__setattr__(self, name, tuple(getattr(self, name)))
+        if self.constant_rads is True:
+            raise ValueError("constant_rads takes the specialties from create_constant_rads(num_rads)")
+        object.__setattr__(self, 'constant_rads', tuple(tuple(spec) for spec in self.constant_rads or ()))
+        #arrays and lists become tuples so the config stays hashable and has a stable cache key
+        params = dict(self.service_params)
+        params = tuple(sorted((name, tuple(np.ravel(value).tolist()) if np.ndim(value) else value) for name, value in params.items()))
+        object.__setattr__(self, 'service_params', params)
+
+    @property
+    def urgencies(self):
+        return tuple(range(1, len(self.arr_times) + 1))
+
+    @property
+    def process_times(self):
+        return dict(zip(self.urgencies, self.proc_times))
+
+    @property
+    def target_times(self):
+        return dict(zip(self.urgencies, self.targ_times))
         
         
 class Radiologist:
     def __init__(self, rad_id, specialties, working=True):
-        self.queue = []
-        self.queue_data = []#[med_image, image_id, image_urgency, time_left, est_time]
+        self.images = None    #ImageStore of the simulation, set by SystemState
+        self.current = None    #img_id being read
+        self.waiting = {}    #FIFO of waiting img_ids per urgency, set up by SystemState
+        self.num_queued = 0    #live images held, including the current one
         self.rad_id = rad_id
         self.specialties = specialties
         self.is_working = working
         self.is_idle = 1
-        self.images_served = []
         self.idle_times = []
         self.time_busy_start = 0
         self.time_idle_start = 0
         self.busy_times = []
+        self.time_joined = 0    #set by SystemState.add_radiologists for radiologists added during a run
         self.time = 0
         self.time_of_step = 0
         self.queue_length = []
-        self.service_starts = []
-        self.service_ends = []
         self.service_time = []  
+        self.workload = 0    #sum of est_process_time over the queue, kept up to date by add_job and remove_job
         
     def get_stats(self):
         return self.idle_times, self.busy_times, self.queue_length, self.service_starts, self.service_ends, self.service_time 
+
+    def served_mask(self):
+        return self.images.rad_seen == self.rad_id
+
+    @property
+    def images_served(self):
+        done = self.served_mask() & ~np.isnan(self.images.time_done)
+        img_ids = np.flatnonzero(done)
+        return img_ids[np.argsort(self.images.time_done[img_ids], kind='stable')].tolist()
+
+    @property
+    def service_starts(self):
+        return np.sort(self.images.time_seen[self.served_mask()]).tolist()
+
+    @property
+    def service_ends(self):
+        ends = self.images.time_done[self.served_mask()]
+        return np.sort(ends[~np.isnan(ends)]).tolist()
         
+    @property
+    def queue(self):
+        #current img_id followed by the live waiting img_ids in the order they will be read
+        queue = [] if self.current is None else [self.current]
+        rad_seen = self.images.rad_seen
+        for waiting in self.waiting.values():
+            queue += [img_id for img_id in waiting if rad_seen[img_id] < 0]
+        return queue
+
     def show_queue(self):
         return self.queue
     
     def estimate_queue_time(self):
-        t = 0
-        for img in self.queue:
-            t += img.est_process_time
-        return t
+        return self.workload
     
-    def add_job(self, med_image, time):
+    def add_job(self, img_id, time):
         #update idle time tracker
         if self.is_idle == 1:
             self.idle_times.append(time - self.time_idle_start)
             self.time_busy_start = time
         self.is_idle = 0
-        #add img to queue and sort
-        #self.queue.append(med_image)
-        #if len(self.queue) > 1:
-        #    self.sort_queue()
-        if len(self.queue) <= 1:
-            self.queue.append(med_image)
-            self.queue_data.append([med_image, med_image.img_id, med_image.urgency, med_image.time_remaining, med_image.est_process_time, med_image.est_process_time]) #[image_id, image_urgency, time_left, est_time]
+        urgency = int(self.images.urgency[img_id])
+        self.workload += self.images.process_times[urgency]
+        self.num_queued += 1
+        self.waiting[urgency].append(img_id)
+
+    def next_job(self):
+        #take the oldest live image of the most urgent level, copies already claimed elsewhere are dropped
+        rad_seen = self.images.rad_seen
+        for waiting in self.waiting.values():
+            while waiting:
+                img_id = waiting.popleft()
+                if rad_seen[img_id] < 0:
+                    self.current = img_id
+                    return img_id
+        return None
+
+    def remove_job(self, img_id):
+        #the current image is done, or a waiting copy was claimed by another radiologist and is left as a tombstone
+        if img_id == self.current:
+            self.current = None
+        self.num_queued -= 1
+        if self.num_queued == 0:
+            self.workload = 0
+            for waiting in self.waiting.values():
+                waiting.clear()
         else:
-            if med_image.urgency == 1:
-                ins_ind = 1
-                for ind, img in enumerate(self.queue[1:]):
-                    if img.urgency > 1:
-                        ins_ind = ind + 1
-                        break          
-                self.queue.insert(ins_ind, med_image)
-            elif med_image.urgency == 2:
-                ins_ind = 1
-                for ind, img in enumerate(self.queue[1:]):
-                    if img.urgency > 2:
-                        ins_ind = ind + 1
-                        break          
-                self.queue.insert(ins_ind, med_image)
-            else:
-                self.queue.append(med_image)
-
-    def sort_queue(self):
-        curr_img = self.queue[0]
-        queue_tuple = [[img, img.urgency] for img in self.queue[1:]]
-        queue_tuple = sorted(queue_tuple, key=lambda x: x[1])
-        #print(queue_tuple)
-        queue_tuple_list = [tup[0] for tup in queue_tuple]
-        self.queue = queue_tuple_list
-        self.queue.insert(0, curr_img)
+            self.workload -= self.images.process_times[int(self.images.urgency[img_id])]
        
     def finish_job(self, time):
-        if len(self.queue) == 0:
+        if self.num_queued == 0:
             self.time_finished_last_job = time
             self.time_idle_start = time
             self.busy_times.append(time - self.time_busy_start)
@@ -210,185 +428,1256 @@ class Radiologist:
             self.idle_times.append(time - self.time_idle_start)
         elif self.is_idle == 0:
             self.busy_times.append(time - self.time_busy_start)
-        
-    def update_queue(self, time):
-        for img in self.queue:
-            img.update_time_remaining(time)
-        #sort_queue()        
-    #def sort_queue(self):
                    
         
         
+class LoadIndex:
+    #Min-heap per image type of (load, rad_id, version) so the least loaded capable radiologists
+    #can be found without scanning all of them. Radiologists whose load changed are only marked
+    #dirty and get a fresh entry at the next query, older entries go stale and are dropped when
+    #they reach the top or when the heap is rebuilt
+    def __init__(self, key):
+        self.key = key        #key(rad) -> current load
+        self.heaps = {}
+        self.members = {}     #image type -> number of indexed radiologists
+        self.rads = {}        #rad_id -> radiologist
+        self.versions = {}    #rad_id -> version of the live entries
+        self.dirty = set()
+
+    def add(self, rad):
+        self.rads[rad.rad_id] = rad
+        for image_type in rad.specialties:
+            self.members[image_type] = self.members.get(image_type, 0) + 1
+        self.dirty.add(rad)
+
+    def remove(self, rad):
+        del self.rads[rad.rad_id]
+        self.versions[rad.rad_id] = self.versions.get(rad.rad_id, 0) + 1
+        self.dirty.discard(rad)
+        for image_type in rad.specialties:
+            self.members[image_type] -= 1
+
+    def update(self, rad):
+        self.dirty.add(rad)
+
+    def flush(self):
+        for rad in self.dirty:
+            rad_id = rad.rad_id
+            version = self.versions.get(rad_id, 0) + 1
+            self.versions[rad_id] = version
+            entry = (self.key(rad), rad_id, version)
+            for image_type in rad.specialties:
+                heap = self.heaps.setdefault(image_type, [])
+                heapq.heappush(heap, entry)
+                if len(heap) > 2 * self.members[image_type] + 32:
+                    self.rebuild(image_type)
+        self.dirty.clear()
+
+    def rebuild(self, image_type):
+        heap = [entry for entry in self.heaps[image_type] if self.versions[entry[1]] == entry[2]]
+        heapq.heapify(heap)
+        self.heaps[image_type] = heap
+
+    def smallest(self, image_type, n):
+        #the n radiologists with the lowest load, ties go to the lowest rad_id
+        self.flush()
+        heap = self.heaps.get(image_type, [])
+        live = []
+        while heap and len(live) < n:
+            entry = heapq.heappop(heap)
+            if self.versions[entry[1]] == entry[2]:
+                live.append(entry)
+        for entry in live:
+            heapq.heappush(heap, entry)
+        return [self.rads[entry[1]] for entry in live]
+        
+        
+class ImageRecorder:
+    #Growable buffer of img_ids in the order they were recorded. The table columns are read from
+    #the ImageStore when the table is first read
+    columns = ['img_id','urgency', 'rad_id', 'time_created','time_rad_job_starts', 'time_job_finished', 'wait_time', 'time_w_rad', 'total_time']
+
+    def __init__(self, images, capacity=1024):
+        self.images = images
+        self.size = 0
+        self.img_id = np.empty(capacity, dtype=np.int64)
+        self.end_time = None    #if set, images are reported as finishing at end_time (used for unfinished images)
+        self.table = None
+        self.drained = 0    #records before this were already handed out by drain
+
+    def __len__(self):
+        return self.size
+
+    def record(self, img_id):
+        if self.size == len(self.img_id):
+            img_ids = np.empty(2 * len(self.img_id), dtype=np.int64)
+            img_ids[:self.size] = self.img_id
+            self.img_id = img_ids
+        self.img_id[self.size] = img_id
+        self.size += 1
+        self.table = None
+
+    def frame(self, img_ids):
+        images = self.images
+        created = images.time_created[img_ids]
+        seen = images.time_seen[img_ids]
+        if self.end_time is None:
+            done = images.time_done[img_ids]
+        else:
+            done = np.full(len(img_ids), self.end_time, dtype=float)
+        rad_seen = images.rad_seen[img_ids]
+        rad_id = pd.array(rad_seen, dtype="Int64")
+        rad_id[rad_seen < 0] = pd.NA
+        return pd.DataFrame({
+            'img_id': img_ids,
+            'urgency': images.urgency[img_ids],
+            'rad_id': rad_id,
+            'time_created': created,
+            'time_rad_job_starts': seen,
+            'time_job_finished': done,
+            'wait_time': seen - created,
+            'time_w_rad': done - seen,
+            'total_time': done - created,
+        }, columns=self.columns)
+
+    def to_frame(self):
+        if self.table is None:
+            self.table = self.frame(self.img_id[:self.size].copy())
+        return self.table
+
+    def drain(self, keep=True):
+        #Rows recorded since the last drain. With keep=False they are also dropped from the buffer so a
+        #streaming reader runs in constant memory, to_frame then only has the rows not drained yet
+        img_ids = self.img_id[self.drained:self.size].copy()
+        if keep:
+            self.drained = self.size
+        else:
+            self.size = 0
+            self.drained = 0
+            self.table = None
+        return self.frame(img_ids)
+        
+        
+class EventLog:
+    #Columnar event history of (time, kind, img_id, rad_id), -1 where an id does not apply.
+    #With max_events set only the most recent max_events are kept, as a ring buffer
+    columns = ['time', 'kind', 'img_id', 'rad_id']
+
+    def __init__(self, event_names, max_events=None, capacity=1024):
+        self.event_names = event_names
+        self.max_events = max_events
+        if max_events is not None:
+            capacity = max_events
+        self.time = np.empty(capacity)
+        self.kind = np.empty(capacity, dtype=np.int16)
+        self.img_id = np.empty(capacity, dtype=np.int64)
+        self.rad_id = np.empty(capacity, dtype=np.int32)
+        self.size = 0     #events held
+        self.total = 0    #events recorded, including ones dropped from the ring
+
+    def __len__(self):
+        return self.size
+
+    def record(self, time, kind, img_id=-1, rad_id=-1):
+        if self.max_events is None:
+            if self.size == len(self.time):
+                for name in self.columns:
+                    old = getattr(self, name)
+                    new = np.empty(2 * len(old), dtype=old.dtype)
+                    new[:self.size] = old
+                    setattr(self, name, new)
+            i = self.size
+            self.size += 1
+        else:
+            i = self.total % self.max_events
+            self.size = min(self.size + 1, self.max_events)
+        self.time[i] = time
+        self.kind[i] = kind
+        self.img_id[i] = img_id
+        self.rad_id[i] = rad_id
+        self.total += 1
+
+    def arrays(self):
+        #columns in the order the events happened
+        if self.max_events is None or self.total <= self.max_events:
+            return {name: getattr(self, name)[:self.size].copy() for name in self.columns}
+        start = self.total % self.max_events
+        return {name: np.roll(getattr(self, name), -start) for name in self.columns}
+
+    def to_frame(self):
+        table = pd.DataFrame(self.arrays())
+        table['event'] = pd.Categorical.from_codes(table['kind'], categories=self.event_names)
+        return table
+
+    def to_arrow(self):
+        try:
+            import pyarrow as pa
+        except ImportError:
+            raise ImportError("EventLog.to_arrow needs pyarrow (pip install pyarrow)")
+        arrays = self.arrays()
+        table = pa.table(arrays)
+        return table.append_column('event', pa.DictionaryArray.from_arrays(arrays['kind'].astype(np.int32), self.event_names))
+
+    def to_parquet(self, path):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError("EventLog.to_parquet needs pyarrow (pip install pyarrow)")
+        pq.write_table(self.to_arrow(), path)
+        
+        
+class QueueStats:
+    #Time-weighted queue length statistics per radiologist and for the whole system.
+    #Only updated when a queue changes length, a sampled trace is kept if trace_resolution is set
+    #(trace_resolution=0 records every change)
+    def __init__(self, num_rads, start_time=0, trace_resolution=None):
+        self.start_time = start_time
+        self.rad_start = [start_time] * num_rads    #when each radiologist joined, stats of later ones start there
+        self.lengths = [0] * num_rads
+        self.last_change = [start_time] * num_rads
+        self.area = [0.0] * num_rads        #integral of queue length over time
+        self.area_sq = [0.0] * num_rads     #integral of squared queue length over time
+        self.max = [0] * num_rads
+        self.window_max = [0] * num_rads    #max since the last window() call
+        self.window_area = np.zeros(num_rads + 1)
+        self.window_area_sq = np.zeros(num_rads + 1)
+        self.window_start = start_time
+        self.total = 0
+        self.total_last_change = start_time
+        self.total_area = 0.0
+        self.total_area_sq = 0.0
+        self.total_max = 0
+        self.window_total_max = 0
+        self.trace_resolution = trace_resolution
+        self.next_sample = start_time
+        self.queue_lengths = []
+        self.time_steps = []
+
+    def reset(self, time):
+        #forget everything before time, keeping the current queue lengths
+        num_rads = len(self.lengths)
+        self.start_time = time
+        self.last_change = [time] * num_rads
+        self.area = [0.0] * num_rads
+        self.area_sq = [0.0] * num_rads
+        self.max = list(self.lengths)
+        self.window_max = list(self.lengths)
+        self.window_area = np.zeros(num_rads + 1)
+        self.window_area_sq = np.zeros(num_rads + 1)
+        self.window_start = time
+        self.total_last_change = time
+        self.total_area = 0.0
+        self.total_area_sq = 0.0
+        self.total_max = self.total
+        self.window_total_max = self.total
+        self.next_sample = time
+        self.queue_lengths = []
+        self.time_steps = []
+
+    def add_rad(self, time):
+        self.rad_start.append(time)
+        self.lengths.append(0)
+        self.last_change.append(time)
+        self.area.append(0.0)
+        self.area_sq.append(0.0)
+        self.max.append(0)
+        self.window_max.append(0)
+        self.window_area = np.insert(self.window_area, -1, 0.0)
+        self.window_area_sq = np.insert(self.window_area_sq, -1, 0.0)
+
+    def sample(self, time):
+        while self.next_sample <= time:
+            self.queue_lengths.append(list(self.lengths))
+            self.time_steps.append(self.next_sample)
+            self.next_sample += self.trace_resolution
+
+    def update(self, rad_id, length, time):
+        old = self.lengths[rad_id]
+        if length == old:
+            return
+        if self.trace_resolution:
+            self.sample(time)
+        dt = time - self.last_change[rad_id]
+        self.area[rad_id] += old * dt
+        self.area_sq[rad_id] += old * old * dt
+        self.last_change[rad_id] = time
+        self.lengths[rad_id] = length
+        if length > self.max[rad_id]:
+            self.max[rad_id] = length
+        if length > self.window_max[rad_id]:
+            self.window_max[rad_id] = length
+        dt = time - self.total_last_change
+        self.total_area += self.total * dt
+        self.total_area_sq += self.total * self.total * dt
+        self.total_last_change = time
+        self.total += length - old
+        if self.total > self.total_max:
+            self.total_max = self.total
+        if self.total > self.window_total_max:
+            self.window_total_max = self.total
+        if self.trace_resolution == 0:
+            self.queue_lengths.append(list(self.lengths))
+            self.time_steps.append(time)
+
+    def integrals(self, time):
+        #current lengths and the area and squared area under them up to time, per radiologist then system
+        lengths = np.array(self.lengths + [self.total], dtype=float)
+        dt = time - np.array(self.last_change + [self.total_last_change])
+        area = np.array(self.area + [self.total_area]) + lengths * dt
+        area_sq = np.array(self.area_sq + [self.total_area_sq]) + lengths * lengths * dt
+        return lengths, area, area_sq
+
+    def durations(self, time, start):
+        #time measured for each radiologist since start or since it joined, then for the system
+        return time - np.maximum(start, np.array(self.rad_start + [start], dtype=float))
+
+    def table(self, lengths, area, area_sq, duration, maxes):
+        #rows that have not been measured for any time yet show their current length
+        timed = duration > 0
+        mean = lengths.copy()
+        var = np.zeros(len(lengths))
+        mean[timed] = area[timed] / duration[timed]
+        var[timed] = np.maximum(area_sq[timed] / duration[timed] - mean[timed] * mean[timed], 0)
+        index = list(range(len(self.lengths))) + ['system']
+        return pd.DataFrame({'mean': mean, 'var': var, 'max': maxes}, index=index)
+
+    def summary(self, time):
+        #mean, variance and max of the queue lengths from start_time up to time
+        lengths, area, area_sq = self.integrals(time)
+        return self.table(lengths, area, area_sq, self.durations(time, self.start_time), self.max + [self.total_max])
+
+    def window(self, time):
+        #same as summary but only since the previous window() call, for reading stats while a run goes on
+        lengths, area, area_sq = self.integrals(time)
+        table = self.table(lengths, area - self.window_area, area_sq - self.window_area_sq, self.durations(time, self.window_start),
+                           self.window_max + [self.window_total_max])
+        self.window_area, self.window_area_sq, self.window_start = area, area_sq, time
+        self.window_max = list(self.lengths)
+        self.window_total_max = self.total
+        return table
+        
+        
 class SystemState:
-    def __init__(self, sim_duration, events, images, rads, cutoff=False, verbose=False):
+    def __init__(self, config, events, images, rads, verbose=False, queue_trace=None, rng=None, event_history=False, history_limit=None):
         self.time = 0
-        self.sim_duration = sim_duration
+        self.config = config
+        self.sim_duration = config.sim_time
         self.continue_running = True
         self.events = events
+        self.event_seq = itertools.count(len(events))
         self.images = images
+        self.copies = {}    #img_id -> radiologists holding a copy, until one of them starts reading it
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+        #config.service_sampler(mean, rng, **service_params) builds the sampler of each urgency
+        params = dict(config.service_params)
+        self.service_samplers = {urgency: config.service_sampler(mean, rng, **params) for urgency, mean in config.process_times.items()}
+        self.uniform = UniformSampler(1.0, rng)
+        self.next_arrival = 0    #img_id of the next image to arrive
+        self.next_arrival_time = float(images.time_created[0]) if len(images) > 0 else np.inf
         self.rads = rads
-        self.rads_working = rads
+        for rad in rads:
+            rad.images = images
+            rad.waiting = {urgency: deque() for urgency in config.urgencies}
+        self.rads_working = []
         self.rads_not_working = []
-        self.events_history = []
-        self.queue_lengths = []
-        self.time_steps = []
-        self.img_table = pd.DataFrame(columns=['img_id','urgency', 'rad_id', 'time_created','time_rad_job_starts', 'time_job_finished', 'wait_time', 'time_w_rad', 'total_time'])
+        self.capable_rads = {}    #image type -> working radiologists able to read it, ordered by rad_id
+        self.length_index = LoadIndex(attrgetter('num_queued'))      #working radiologists keyed on queue length
+        self.workload_index = LoadIndex(attrgetter('workload'))      #working radiologists keyed on estimated queue time
+        for rad in rads:
+            if rad.is_working:
+                self.add_working_rad(rad)
+            else:
+                self.rads_not_working.append(rad)
+        self.queue_stats = QueueStats(len(rads), trace_resolution=queue_trace)
+        self.completed = ImageRecorder(images)
+        self.unfinished = ImageRecorder(images)
         self.rad_table = pd.DataFrame()
-        self.unfin_img_table = pd.DataFrame(columns=['img_id','urgency', 'rad_id', 'time_created','time_rad_job_starts', 'time_job_finished', 'wait_time', 'time_w_rad', 'total_time'])
         self.verbose = verbose
+        #handler(obj) for each event kind
+        self.handlers = [self.distribute_job, self.complete_job, self.stop_simulation, self.add_working_rad, self.remove_working_rad, None, self.deadline_missed]
+        self.event_names = list(EVENT_NAMES)
+        #(time_due, img_id) of every arrived image, popped as the clock passes it. Per urgency counts of images
+        #read by their target time, past it (read late or still waiting), and still waiting but not yet due
+        self.deadlines = []
+        self.on_time = {urgency: 0 for urgency in config.urgencies}
+        self.late = {urgency: 0 for urgency in config.urgencies}
+        self.pending = {urgency: 0 for urgency in config.urgencies}
+        self.misses = 0
+        self.miss_budget = config.miss_budget
+        self.stopped_early = False
+        self.stats_start = 0    #time the statistics were last reset, see reset_statistics
+        #off by default, history_limit keeps only the most recent events
+        self.events_history = EventLog(self.event_names, history_limit) if event_history else None
+        self.finished = False
+        if self.next_event_time() == np.inf:
+            self.continue_running = False
         
-    def create_event(self, time, event_type, obj):
-        self.events.append([time, event_type, obj])
-        self.events = sorted(self.events, key=lambda x: x[0])
-
-    def update_img_table(self, med_img):
-        column_names = ['img_id','urgency', 'rad_id', 'time_created','time_rad_job_starts', 'time_job_finished', 'wait_time', 'time_w_rad', 'total_time']
-        values = [med_img.img_id, med_img.urgency, med_img.rad_seen, med_img.time_created, med_img.time_seen, self.time, med_img.time_seen - med_img.time_created, self.time - med_img.time_seen, self.time - med_img.time_created] #[[med_img.time_created], [med_img.time_seen], [self.time], [self.time - med_img.time_seen], [self.time - med_img.time_created]]
-        temp_df = pd.DataFrame(values).T
-        temp_df.columns = column_names
-        #self.img_table = self.img_table.append(temp_df, ignore_index = True)
-        self.img_table = pd.concat([self.img_table, temp_df], ignore_index=True)
+    def create_event(self, time, kind, obj):
+        heapq.heappush(self.events, (time, next(self.event_seq), kind, obj))
+
+    def register_event(self, name, handler):
+        #adds a new event kind dispatched to handler(obj), returns its code for create_event
+        self.handlers.append(handler)
+        self.event_names.append(name)
+        return len(self.handlers) - 1
+
+    def log_event(self, event):
+        time, kind, obj = event[0], event[2], event[3]
+        if isinstance(obj, Radiologist):
+            img_id = -1 if obj.current is None else obj.current
+            self.events_history.record(time, kind, img_id, obj.rad_id)
+        elif isinstance(obj, (int, np.integer)):
+            self.events_history.record(time, kind, obj)
+        else:
+            #no payload, or one of an event added with register_event that isn't an img_id
+            self.events_history.record(time, kind)
+
+    def stop_simulation(self, obj=None):
+        self.continue_running = False
+
+    def check_deadlines(self, t):
+        #fires a miss for every image due before t that is still not read
+        deadlines = self.deadlines
+        time_done = self.images.time_done
+        while deadlines and deadlines[0][0] < t and self.continue_running:
+            time_due, img_id = heapq.heappop(deadlines)
+            if time_done[img_id] != time_done[img_id]:    #NaN, not read yet
+                self.time = max(self.time, time_due)
+                if self.events_history is not None:
+                    self.events_history.record(time_due, DEADLINE_MISS, img_id)
+                self.handlers[DEADLINE_MISS](img_id)
+
+    def deadline_missed(self, img_id):
+        urgency = int(self.images.urgency[img_id])
+        self.pending[urgency] -= 1
+        self.late[urgency] += 1
+        self.misses += 1
+        if self.verbose==True:
+            print(f"Image {img_id} missed its target time at {self.time}")
+        if self.miss_budget is not None and self.misses > self.miss_budget:
+            self.stopped_early = True
+            self.stop_simulation()
+
+    def sla_counts(self):
+        #live per urgency counts of images read on time, late (missed the target) and still pending
+        return pd.DataFrame({'on_time': self.on_time, 'late': self.late, 'pending': self.pending}).rename_axis('urgency')
+
+    @property
+    def queue_lengths(self):
+        return self.queue_stats.queue_lengths
+
+    @property
+    def time_steps(self):
+        return self.queue_stats.time_steps
+
+    def queue_summary(self):
+        return self.queue_stats.summary(self.time)
+
+    def queue_changed(self, rad):
+        self.queue_stats.update(rad.rad_id, rad.num_queued, self.time)
+        if rad.is_working:
+            self.length_index.update(rad)
+            self.workload_index.update(rad)
+
+    @property
+    def img_table(self):
+        return self.completed.to_frame()
+
+    @property
+    def unfin_img_table(self):
+        return self.unfinished.to_frame()
+
+    def update_img_table(self, img_id):
+        self.completed.record(img_id)
         
     def unfinished_jobs(self):
-        unfin_med_images = []
+        unfin_img_ids = set()
         for rad in self.rads:
-            unfin_med_images += rad.queue
-            unfin_med_images = list(set(unfin_med_images))
-        print(f"There are {len(unfin_med_images)} that were not completed in time")
-        column_names = [['img_id','urgency', 'rad_id', 'time_created','time_rad_job_starts', 'time_job_finished', 'wait_time', 'time_w_rad', 'total_time']]
-        for med_img in unfin_med_images:
-            values = [med_img.img_id, med_img.urgency, med_img.rad_seen, med_img.time_created, med_img.time_seen, self.time, med_img.time_seen - med_img.time_created, self.time - med_img.time_seen, self.time - med_img.time_created] #[[med_img.time_created], [med_img.time_seen], [self.time], [self.time - med_img.time_seen], [self.time - med_img.time_created]]
-            temp_df = pd.DataFrame(values).T
-            temp_df.columns = column_names
-            self.unfin_img_table = pd.concat([self.unfin_img_table, temp_df], ignore_index = True)
+            unfin_img_ids.update(rad.queue)
+        print(f"There are {len(unfin_img_ids)} that were not completed in time")
+        for img_id in sorted(unfin_img_ids):
+            self.unfinished.record(img_id)
+        self.unfinished.end_time = self.time
         
+    def next_event_time(self):
+        #arrivals win ties so they are seen before anything else scheduled at the same time
+        if self.events and self.events[0][0] < self.next_arrival_time:
+            return self.events[0][0]
+        return self.next_arrival_time
+
+    def arrive(self):
+        img_id = self.next_arrival
+        heapq.heappush(self.deadlines, (float(self.images.time_due[img_id]), img_id))
+        self.pending[int(self.images.urgency[img_id])] += 1
+        self.next_arrival += 1
+        if self.next_arrival < len(self.images):
+            self.next_arrival_time = float(self.images.time_created[self.next_arrival])
+        else:
+            self.next_arrival_time = np.inf
+        return img_id
+
     def process_event(self):
-        event = self.events[0]
-        self.events_history.append(event)
+        #returns the event processed, None if a deadline miss stopped the run first
+        if self.deadlines and self.deadlines[0][0] < self.next_event_time():
+            self.check_deadlines(self.next_event_time())
+            if not self.continue_running:
+                return None
+        if self.events and self.events[0][0] < self.next_arrival_time:
+            event = heapq.heappop(self.events)
+        else:
+            event = (self.next_arrival_time, next(self.event_seq), NEW_JOB, self.arrive())
+        if self.events_history is not None:
+            self.log_event(event)
         self.time = event[0]       
-        event_type = event[1]
-        del self.events[0]
-        temp_list = []
-        for r in self.rads:
-            temp_list.append(len(r.queue))
-        self.queue_lengths.append(temp_list)
-        self.time_steps.append(self.time)        
-            
-        if event_type == "New Job":
-            self.distribute_job(event[2])
-        elif event_type == "Job Done":
-            rad = event[2]
-            self.complete_job(rad)
-        elif event_type == "Sim End":
-            self.continue_running = False 
+        self.handlers[event[2]](event[3])
         if self.verbose==True:
-            print("Event processed")
-        if (len(self.events) == 0) or (self.events[0][1]=="Sim End"):
+            print(f"{self.event_names[event[2]]} event processed")
+        if self.next_event_time() == np.inf:
             self.continue_running = False 
-        if self.continue_running:
+        elif self.next_arrival_time == np.inf and len(self.events) == 1 and self.events[0][2] == SIM_END:
+            #nothing left but the cutoff, end at the last real event like before
+            self.continue_running = False 
+        return event
+
+    def end_simulation(self):
+        if self.finished:
+            return
+        self.finished = True
+        for rad in self.rads:
+            rad.update_idle_lists(self.time)
+        self.unfinished_jobs()
+        print(f"Simulation complete at {self.time} minutes")
+
+    def step(self, n=1):
+        # process at most n events, returns how many were processed
+        processed = 0
+        while self.continue_running and processed < n:
             self.process_event()
+            processed += 1
+        if not self.continue_running:
+            self.end_simulation()
+        return processed
+
+    def run_events(self, n):
+        #same as step(n)
+        return self.step(n)
+
+    def iter_events(self):
+        #Generator processing one event per next() and yielding (time, event name, obj), the run can be
+        #inspected or steered between events. Finishes the simulation when the events run out
+        while self.continue_running:
+            event = self.process_event()
+            if event is not None:
+                yield event[0], self.event_names[event[2]], event[3]
+        self.end_simulation()
+
+    def drain_completed(self, keep=True):
+        #completed image records since the last call, see ImageRecorder.drain
+        return self.completed.drain(keep)
+
+    def drain_queue_stats(self):
+        #queue length stats since the last call
+        return self.queue_stats.window(self.time)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        #itertools.count can't be pickled, skipping a sequence number is harmless
+        state['event_seq'] = next(self.event_seq)
+        return state
+
+    def __setstate__(self, state):
+        state['event_seq'] = itertools.count(state['event_seq'])
+        self.__dict__.update(state)
+
+    def checkpoint(self):
+        #Everything needed to carry on the run (clock, event calendar, queues, Generator state, recorded
+        #images and stats) as compressed bytes for restore. Handlers added with register_event have to be picklable
+        return zlib.compress(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+
+    @classmethod
+    def restore(cls, data):
+        return pickle.loads(zlib.decompress(data))
+
+    def save_checkpoint(self, path):
+        #written to a temporary file first so a crash mid-write keeps the previous checkpoint
+        tmp = f"{path}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(self.checkpoint())
+        os.replace(tmp, path)
+
+    @classmethod
+    def load_checkpoint(cls, path):
+        with open(path, 'rb') as f:
+            return cls.restore(f.read())
+
+    def fork(self):
+        #independent copy that continues from the same point with the same random stream, e.g. to try
+        #several what-if changes on one warmed up run
+        return pickle.loads(pickle.dumps(self, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def reseed(self, seed=None):
+        #Puts the run on a new random stream from here on: the arrivals not seen yet are drawn again and the
+        #samplers restart, so runs restored from one checkpoint and reseeded are independent replications
+        rng = np.random.default_rng(seed)
+        self.rng = rng
+        for sampler in list(self.service_samplers.values()) + [self.uniform]:
+            sampler.reset(rng)
+        remaining = self.sim_duration - self.time
+        if remaining > 0:
+            arrivals_dict, arrival_times, urgencies = create_arrival_times(remaining, self.config.arr_times, rng)
+            arrival_times = arrival_times + self.time
+        else:
+            arrival_times, urgencies = np.empty(0), np.empty(0, dtype=np.int8)
+        image_types = rng.choice(np.array(self.config.specialties), len(arrival_times))
+        self.images.replace_future(self.next_arrival, arrival_times, urgencies, image_types)
+        if self.next_arrival < len(self.images):
+            self.next_arrival_time = float(self.images.time_created[self.next_arrival])
         else:
-            for rad in self.rads:
-                rad.update_idle_lists(self.time)
-            self.unfinished_jobs()
-            print(f"Simulation complete at {self.time} minutes")
+            self.next_arrival_time = np.inf
+
+    def reset_statistics(self):
+        #Drops everything measured so far (completed images, queue stats, SLA counts, idle and busy times, event
+        #history) and measures from the current time on. The queues and event calendar are untouched, used to
+        #throw away a warm-up period
+        self.completed = ImageRecorder(self.images)
+        self.queue_stats.reset(self.time)
+        for urgency in self.on_time:
+            self.on_time[urgency] = 0
+            self.late[urgency] = 0
+        self.misses = 0
+        for rad in self.rads:
+            rad.idle_times = []
+            rad.busy_times = []
+            if rad.is_idle == 1:
+                rad.time_idle_start = self.time
+            else:
+                rad.time_busy_start = self.time
+        if self.events_history is not None:
+            self.events_history = EventLog(self.event_names, self.events_history.max_events)
+        self.stats_start = self.time
+
+    def add_radiologists(self, specialties):
+        #adds a working radiologist for each list of specialties at the current time, returns them
+        new_rads = []
+        for specialties_temp in specialties:
+            rad = Radiologist(len(self.rads), list(specialties_temp))
+            rad.images = self.images
+            rad.waiting = {urgency: deque() for urgency in self.config.urgencies}
+            rad.time_idle_start = self.time
+            rad.time_joined = self.time
+            self.rads.append(rad)
+            self.queue_stats.add_rad(self.time)
+            self.add_working_rad(rad)
+            new_rads.append(rad)
+        self.config = replace(self.config, num_rads=len(self.rads))
+        return new_rads
+
+    def reconfigure(self, **changes):
+        #changes the SimConfig fields that can safely change mid run, e.g. s.reconfigure(fanout='top_k')
+        allowed = ('fanout', 'fanout_k', 'miss_budget')
+        for name in changes:
+            if name not in allowed:
+                raise ValueError(f"{name} can't be changed during a run, only {allowed}")
+        self.config = replace(self.config, **changes)
+        self.miss_budget = self.config.miss_budget
+
+    def run_until(self, t):
+        # process every event scheduled at or before t, then advance the clock to t
+        while self.continue_running and self.next_event_time() <= t:
+            self.process_event()
+        if self.continue_running:
+            self.check_deadlines(t)
+        if self.continue_running:
+            self.time = max(self.time, t)
+        else:
+            self.end_simulation()
+        return self.time
                 
-    def distribute_job(self, med_image):
-        urgency = med_image.urgency
-        image_type = med_image.image_type
+    def distribute_job(self, img_id):
+        image_type = int(self.images.image_type[img_id])
         # Function to route medical images based on some algorithm
         chosen_rads = self.choose_rads(image_type)       
+        if len(chosen_rads) == 0:
+            return
+        holders = []
+        self.copies[img_id] = holders    #keep track of which rads have image in queue
         for rad in chosen_rads:
-            rad.add_job(med_image, self.time)
-            med_image.in_queues.append(rad)    #keep track of which rads have image in queue
-            if len(rad.queue)==1:
+            rad.add_job(img_id, self.time)
+            self.queue_changed(rad)
+            holders.append(rad)
+            if rad.current is None:
                 self.start_job(rad)
                 break         
-        self.update_queues() 
         
+    def add_working_rad(self, rad):
+        if rad.is_working and rad in self.rads_working:
+            return
+        if rad in self.rads_not_working:
+            self.rads_not_working.remove(rad)
+        bisect.insort(self.rads_working, rad, key=lambda r: r.rad_id)
+        rad.is_working = True
+        for image_type in rad.specialties:
+            bisect.insort(self.capable_rads.setdefault(image_type, []), rad, key=lambda r: r.rad_id)
+        self.length_index.add(rad)
+        self.workload_index.add(rad)
+
+    def remove_working_rad(self, rad):
+        #rad keeps working through its queue but is not sent any new images
+        if not rad.is_working:
+            return
+        self.rads_working.remove(rad)
+        self.rads_not_working.append(rad)
+        rad.is_working = False
+        for image_type in rad.specialties:
+            self.capable_rads[image_type].remove(rad)
+        self.length_index.remove(rad)
+        self.workload_index.remove(rad)
+
     def choose_rads(self, image_type):
-        capable_rads = []
-        for rad in self.rads_working:      #finds radiologists capable of working on image
-            if image_type in rad.specialties:
-                capable_rads.append(rad)
-        chosen_rads = self.n_quickest_queues(capable_rads, 3)
-        return capable_rads
+        #radiologists to queue a copy of the image with, in the order they are offered it (see SimConfig.fanout)
+        capable_rads = self.capable_rads.get(image_type, [])    #radiologists capable of working on image
+        fanout = self.config.fanout
+        if fanout == 'broadcast' or len(capable_rads) <= 1:
+            return capable_rads
+        if fanout == 'top_k':
+            return self.n_quickest_queues(image_type, self.config.fanout_k)
+        #power_of_d, sampled with replacement
+        n = len(capable_rads)
+        sampled = [capable_rads[int(self.uniform() * n)] for i in range(self.config.fanout_k)]
+        return [min(sampled, key=lambda rad: (rad.workload, rad.rad_id))]
     
-    def n_shortest_queues(self, rads_list, n):
-        rads_tuples = []
-        for rad in rads_list:
-            rads_tuples.append([rad, len(rad.queue)])
-        rads_tuples.sort(key = lambda x: x[1])
-        return [rad[0] for rad in rads_tuples[:n]]
+    def n_shortest_queues(self, image_type, n):
+        #n working radiologists able to read image_type with the fewest images queued
+        return self.length_index.smallest(image_type, n)
     
-    def n_quickest_queues(self, rads_list, n):
-        rads_tuples = []
-        for rad in rads_list:
-            rads_tuples.append([rad, rad.estimate_queue_time()])
-        rads_tuples.sort(key = lambda x: x[1])
-        return [rad[0] for rad in rads_tuples[:n]]
-             
-    def update_queues(self):
-        for rad in self.rads_working:
-            rad.update_queue(self.time)
+    def n_quickest_queues(self, image_type, n):
+        #n working radiologists able to read image_type with the least estimated work queued
+        return self.workload_index.smallest(image_type, n)
                 
     def start_job(self, rad):
-        med_image = rad.queue[0]
-        image_type = med_image.image_type
-        urgency = med_image.urgency
-        rad.service_starts = self.time
-        med_image.time_seen = self.time
-        med_image.rad_seen = rad.rad_id
-        self.events_history.append([self.time, "Job Started", med_image])
-        process_time = np.random.exponential(G.target_times[urgency])
-        self.create_event(self.time+process_time, "Job Done", rad)
+        img_id = rad.next_job()
+        urgency = int(self.images.urgency[img_id])
+        #claims the image, copies still queued elsewhere are skipped from now on
+        self.images.rad_seen[img_id] = rad.rad_id
+        self.images.time_seen[img_id] = self.time
+        if self.events_history is not None:
+            self.events_history.record(self.time, JOB_STARTED, img_id, rad.rad_id)
+        process_time = self.service_samplers[urgency]()
+        self.create_event(self.time+process_time, JOB_DONE, rad)
         if self.verbose==True:
-            print(f"Image {med_image.img_id} is seen by radiologist {rad.rad_id} at {self.time}")
-        for r in med_image.in_queues:
-            if r != rad:
-                r.queue.remove(med_image)           
+            print(f"Image {img_id} is seen by radiologist {rad.rad_id} at {self.time}")
+        for r in self.copies.pop(img_id, ()):
+            if r is not rad:
+                r.remove_job(img_id)           
+                self.queue_changed(r)
         
     def complete_job(self, rad):
-        med_image = rad.queue[0]
-        self.update_img_table(med_image)
-        rad.images_served.append(med_image.img_id)
-        rad.service_ends.append(self.time)
-        med_image.time_done = self.time
+        img_id = rad.current
+        self.images.time_done[img_id] = self.time
+        if self.time <= self.images.time_due[img_id]:
+            urgency = int(self.images.urgency[img_id])
+            self.on_time[urgency] += 1
+            self.pending[urgency] -= 1
+        self.update_img_table(img_id)
         if self.verbose==True:
-            print(f"Image {med_image.img_id} is done by radiologist {rad.rad_id} at {self.time}")
-        del rad.queue[0]
+            print(f"Image {img_id} is done by radiologist {rad.rad_id} at {self.time}")
+        rad.remove_job(img_id)
+        self.queue_changed(rad)
         rad.finish_job(self.time)
-        if len(rad.queue) > 0:
+        if rad.num_queued > 0:
             self.start_job(rad)
 
     def run_simulation(self):
-        self.process_event()
+        self.run_until(np.inf)
 
-def gen_system_state(sim_time, rads_count, arr_rates, urg_times, constant_rads, cutoff, verbose):
-    #Define urgency times
-    update_globals(urg_times)
+def gen_system_state(config, verbose=False, queue_trace=None, seed=None, event_history=False, history_limit=None):
+    #One generator drives the whole run so a seed reproduces it exactly
+    rng = np.random.default_rng(seed)
     #Create the intervals
-    arrivals_dict, arrival_times_tuples_list = create_arrival_times(sim_time, arr_rates)
+    arrivals_dict, arrival_times, urgencies = create_arrival_times(config.sim_time, config.arr_times, rng)
     #Create the images with their arrival time_seen
-    med_images = create_medical_images(arrival_times_tuples_list)
+    med_images = create_medical_images(config, arrival_times, urgencies, rng)
     #Create the radiologists
-    radiologists = create_radiologists(rads_count, constant_rads)
+    radiologists = create_radiologists(config, rng)
     #Create the image arrival events
-    events = create_initial_events(sim_time, med_images, cutoff)
-    s = SystemState(sim_time, events, med_images, radiologists, cutoff, verbose)
+    events = create_initial_events(config.sim_time, med_images, config.cutoff)
+    s = SystemState(config, events, med_images, radiologists, verbose, queue_trace, rng, event_history, history_limit)
     return s
 
 
-def sim(sim_time, rads_count, arr_rates, urg_times, constant_rads=False, cutoff=False, verbose=False):  
-    s = gen_system_state(sim_time, rads_count, arr_rates, urg_times, constant_rads, cutoff, verbose)
-    s.run_simulation()    
+def run_config(config, verbose=False, queue_trace=None, seed=None, event_history=False, history_limit=None, progress=None, progress_step=None):
+    #progress(s), if given, is called every progress_step simulated minutes (default 1% of sim_time)
+    s = gen_system_state(config, verbose, queue_trace, seed, event_history, history_limit)
+    if progress is None:
+        s.run_simulation()
+    else:
+        step = progress_step or config.sim_time / 100
+        while not s.finished:
+            s.run_until(s.time + step)
+            progress(s)
     return s
 
 
+def sim(sim_time, rads_count, arr_rates, urg_times, constant_rads=False, cutoff=False, verbose=False, queue_trace=None, seed=None, service_sampler=ExponentialSampler, event_history=False, history_limit=None, targ_times=None, perc_special=1.0, service_params=()):  
+    if targ_times is None:
+        targ_times = tuple(G.target_times.values())
+    config = SimConfig(sim_time, rads_count, arr_rates, urg_times, targ_times, constant_rads, cutoff, perc_special, service_sampler=service_sampler, service_params=service_params)
+    s = run_config(config, verbose, queue_trace, seed, event_history, history_limit)
+    return s
+
+
+def replication_summary(s):
+    #Per-urgency results of one finished run as small arrays, so only this needs to be sent back
+    #from a worker process rather than the whole SystemState
+    urgencies = np.array(sorted(s.images.target_times))
+    done = s.img_table
+    unfin = s.unfin_img_table
+    targets = np.array([s.images.target_times[urg] for urg in urgencies])
+    done_urg = np.searchsorted(urgencies, done['urgency'].values)
+    counts = np.bincount(done_urg, minlength=len(urgencies))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        wait_time = np.bincount(done_urg, weights=done['wait_time'].values, minlength=len(urgencies)) / counts
+        total_time = np.bincount(done_urg, weights=done['total_time'].values, minlength=len(urgencies)) / counts
+        on_time = np.bincount(done_urg, weights=done['total_time'].values <= targets[done_urg], minlength=len(urgencies)) / counts
+    busy = sum(np.sum(rad.busy_times) for rad in s.rads)
+    idle = sum(np.sum(rad.idle_times) for rad in s.rads)
+    return {
+        'urgency': urgencies,
+        'wait_time': wait_time,
+        'total_time': total_time,
+        'on_time': on_time,
+        'completed': counts,
+        'unfinished': np.bincount(np.searchsorted(urgencies, unfin['urgency'].values), minlength=len(urgencies)),
+        'utilization': np.full(len(urgencies), busy / (busy + idle) if busy + idle > 0 else np.nan),
+    }
+
+
+def run_replication(config, seed, snapshot=None):
+    #Runs a SimConfig, or sim(**config) for a dict, on its own random stream and returns only the summary arrays.
+    #With a snapshot (see steady_state_snapshot) the run carries on from it instead and only what comes after is measured
+    with contextlib.redirect_stdout(io.StringIO()):
+        if snapshot is not None:
+            s = SystemState.restore(snapshot)
+            s.reseed(seed)
+            s.reset_statistics()
+            s.run_simulation()
+        elif isinstance(config, SimConfig):
+            s = run_config(config, seed=seed)
+        else:
+            s = sim(**config, seed=seed)
+    return replication_summary(s)
+
+
+def mser5(values, batch=5):
+    #MSER-5 truncation point of an output series: how many leading values to drop so that the rest has the
+    #smallest standard error. Works on means of batches of 5 and only looks at the first half of them
+    values = np.asarray(values, dtype=float)
+    n = len(values) // batch
+    if n < 2:
+        return 0
+    means = values[:n * batch].reshape(n, batch).mean(axis=1)
+    #sums over the batch means from d to the end, for every d
+    tail = np.cumsum(means[::-1])[::-1]
+    tail_sq = np.cumsum((means ** 2)[::-1])[::-1]
+    count = n - np.arange(n)
+    stat = (tail_sq - tail ** 2 / count) / count ** 2
+    return int(np.argmin(stat[:n // 2 + 1])) * batch
+
+
+def warmup_time(img_table, metric='wait_time', urgency=None):
+    #end of the warm-up period, the arrival time of the first image kept by MSER-5 on metric in arrival order.
+    #urgency only looks at images of that urgency, the mix of urgencies can hide the warm-up of the slower ones
+    table = img_table if urgency is None else img_table[img_table['urgency'] == urgency]
+    table = table.sort_values('time_created', kind='stable')
+    d = mser5(table[metric].values)
+    return float(table['time_created'].iloc[d]) if d > 0 else 0.0
+
+
+def truncate_warmup(img_table, metric='wait_time', urgency=None):
+    #(img_table without the images that arrived during the warm-up, warm-up time)
+    warmup = warmup_time(img_table, metric, urgency)
+    return img_table[img_table['time_created'] >= warmup], warmup
+
+
+def steady_state_snapshot(config, seed=0, warmup=None, metric='wait_time', urgency=None):
+    #Runs config until the end of its warm-up and returns (checkpoint, warmup). Without warmup a pilot run with
+    #the same seed is truncated with MSER-5 to find it. Pass the checkpoint to run_replications(snapshot=...)
+    #so every replication starts from the same steady state queues and only runs the measured window
+    with contextlib.redirect_stdout(io.StringIO()):
+        if warmup is None:
+            warmup = warmup_time(run_config(config, seed=seed).img_table, metric, urgency)
+        s = gen_system_state(config, seed=seed)
+        s.run_until(warmup)
+    return s.checkpoint(), warmup
+
+
+def summarize_replications(runs, confidence=0.95):
+    #Mean and t-based confidence interval of every metric across replications, per urgency
+    metrics = [col for col in runs.columns if col not in ('rep', 'urgency')]
+    rows = []
+    for urg, group in runs.groupby('urgency'):
+        for metric in metrics:
+            values = group[metric].dropna().values.astype(float)
+            n = len(values)
+            mean = values.mean() if n else np.nan
+            std = values.std(ddof=1) if n > 1 else np.nan
+            half_width = stats.t.ppf((1 + confidence) / 2, n - 1) * std / np.sqrt(n) if n > 1 else np.nan
+            rows.append((urg, metric, n, mean, std, half_width, mean - half_width, mean + half_width))
+    summary = pd.DataFrame(rows, columns=['urgency', 'metric', 'n', 'mean', 'std', 'half_width', 'ci_low', 'ci_high'])
+    return summary.set_index(['urgency', 'metric'])
+
+
+def run_replications(config, n=G.ITERATIONS, workers=None, seed=None, confidence=0.95, snapshot=None):
+    #Runs n independent replications of a SimConfig (or a dict of sim arguments) across a process pool. Every replication gets its
+    #own stream spawned from SeedSequence(seed), so the results only depend on seed and not on workers.
+    #With a snapshot from steady_state_snapshot every replication continues from it and config is not used.
+    #Returns (summary, runs): per-urgency means and confidence intervals, and the per-replication results
+    seeds = np.random.SeedSequence(seed).spawn(n)
+    if workers is None:
+        workers = min(n, os.cpu_count() or 1)
+    if workers <= 1:
+        results = [run_replication(config, seq, snapshot) for seq in seeds]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(run_replication, itertools.repeat(config), seeds, itertools.repeat(snapshot), chunksize=max(1, n // (4 * workers))))
+    runs = collect_runs(results)
+    return summarize_replications(runs, confidence), runs
+
+
+def run_to_precision(config, targets, max_runs=100, min_runs=5, batch=None, workers=None, seed=None, confidence=0.95, snapshot=None):
+    #Adds replications of config (as in run_replications) in batches until the confidence interval half-width of every
+    #target is within its value, e.g. targets={(1, 'wait_time'): 0.5} for urgency 1 mean wait time +-0.5 min, or until
+    #max_runs. Without batch each batch is sized from the current half-widths, which shrink with the square root of
+    #the number of runs, but never more than doubles the runs so far. Replication i always gets the same stream, so the
+    #results only depend on seed. Returns (summary, runs, precision), precision has per target the runs used, the
+    #achieved half-width and whether the target was met
+    targets = pd.Series(targets, dtype=float)
+    targets.index = targets.index.set_names(['urgency', 'metric'])
+    seed_seq = np.random.SeedSequence(seed)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    pool = ProcessPoolExecutor(max_workers=workers) if workers > 1 else None
+    results = []
+    size = max(min_runs, 2)
+    try:
+        while True:
+            seeds = seed_seq.spawn(min(size, max_runs - len(results)))
+            if pool is None:
+                results += [run_replication(config, seq, snapshot) for seq in seeds]
+            else:
+                results += list(pool.map(run_replication, itertools.repeat(config), seeds, itertools.repeat(snapshot)))
+            runs = collect_runs(results)
+            summary = summarize_replications(runs, confidence)
+            precision = summary.loc[targets.index, ['n', 'mean', 'half_width']].assign(target=targets)
+            precision['met'] = precision['half_width'] <= precision['target']
+            print(f"{len(results)} runs, {precision['met'].sum()} of {len(precision)} targets met")
+            if precision['met'].all() or len(results) >= max_runs:
+                break
+            if batch is not None:
+                size = batch
+            else:
+                needed = (len(results) * (precision['half_width'] / precision['target']) ** 2).max()
+                size = int(np.ceil(needed)) - len(results) if np.isfinite(needed) else workers
+                size = min(max(size, 1, workers if pool else 1), len(results))
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    return summary, runs, precision
+
+
+def collect_runs(results):
+    #one row per replication and urgency from a list of replication_summary results
+    runs = pd.concat([pd.DataFrame(result).assign(rep=rep) for rep, result in enumerate(results)], ignore_index=True)
+    return runs[['rep'] + [col for col in runs.columns if col != 'rep']]
+
+
+def sweep_grid(**values):
+    #every combination of the given SimConfig fields, e.g. sweep_grid(num_rads=range(4, 12), perc_special=[0, .5, 1])
+    names = list(values)
+    return [dict(zip(names, combo)) for combo in itertools.product(*values.values())]
+
+
+def _json_default(value):
+    if isinstance(value, type):
+        return value.__name__
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    return list(value)
+
+
+def config_hash(config, *extra):
+    #stable hex digest of a SimConfig and anything else that changes the results (seed, replications, ...)
+    values = {field.name: getattr(config, field.name) for field in fields(config)}
+    text = json.dumps([values, extra], sort_keys=True, default=_json_default)
+    return hashlib.sha256(text.encode()).hexdigest()
+
+
+def run_sweep_point(config, n, seed_seq, confidence=0.95):
+    with contextlib.redirect_stdout(io.StringIO()):
+        runs = collect_runs([run_replication(config, seq) for seq in seed_seq.spawn(n)])
+    return summarize_replications(runs, confidence).reset_index()
+
+
+def load_sweep(store):
+    #Reads a sweep store into one row per point, urgency and metric. A line cut off by an interrupted
+    #sweep is skipped, that point is simply run again on resume
+    records = []
+    if os.path.exists(store):
+        with open(store) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    continue
+    rows = []
+    for record in records:
+        point = {name: tuple(value) if isinstance(value, list) else value for name, value in record['point'].items()}
+        for row in record['summary']:
+            rows.append({'key': record['key'], **point, **row})
+    return pd.DataFrame(rows)
+
+
+def run_sweep(base, points, n=10, store='sweep.jsonl', workers=None, seed=0, confidence=0.95):
+    #Runs n replications at every point, each a dict of SimConfig fields that replace those of base
+    #(see sweep_grid). Points run in parallel and each one is appended to the JSON lines file store as
+    #soon as it finishes, points already in the store are skipped, so an interrupted sweep resumes where it stopped.
+    #Returns the summaries of all the points from the store
+    if isinstance(points, dict):
+        points = sweep_grid(**points)
+    done = set(load_sweep(store).get('key', []))
+    todo = {}
+    for point in points:
+        config = replace(base, **point)
+        key = config_hash(config, n, seed)
+        if key not in done:
+            #the stream of a point only depends on its config and seed, not on the order points run in
+            todo[key] = (point, config, np.random.SeedSequence([seed, int(key[:15], 16)]))
+    print(f"{len(points) - len(todo)} of {len(points)} points already done")
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if os.path.exists(store):
+        #a record cut off mid-write has no newline at the end, drop it so the next record starts on its own line
+        with open(store, 'rb+') as f:
+            data = f.read()
+            if data and not data.endswith(b'\n'):
+                f.truncate(data.rfind(b'\n') + 1)
+    with open(store, 'a') as f:
+        def write(key, summary):
+            record = {'key': key, 'point': todo[key][0], 'n': n, 'seed': seed, 'summary': summary.to_dict('records')}
+            f.write(json.dumps(record, default=_json_default) + '\n')
+            f.flush()
+        if workers <= 1:
+            for key, (point, config, seq) in todo.items():
+                write(key, run_sweep_point(config, n, seq, confidence))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                futures = {pool.submit(run_sweep_point, config, n, seq, confidence): key for key, (point, config, seq) in todo.items()}
+                for i, future in enumerate(as_completed(futures), start=1):
+                    write(futures[future], future.result())
+                    if i % 10 == 0 or i == len(futures):
+                        print(f"{i} of {len(futures)} points run")
+    keys = {config_hash(replace(base, **point), n, seed) for point in points}
+    table = load_sweep(store)
+    return table[table['key'].isin(keys)].reset_index(drop=True)
+
+
+def rad_intervals(images, num_rads, end_time, start_time=0, time_joined=None):
+    #One row per busy or idle stretch of every radiologist from start_time to end_time, all computed at once from the
+    #ImageStore. Busy stretches are reading times (time_seen to time_done, or end_time for an image still being
+    #read) with back to back reads merged, idle stretches are the gaps between them. time_joined has the time each
+    #radiologist joined the run, they are only counted from then on
+    read = np.flatnonzero(images.rad_seen >= 0)
+    rad_id = images.rad_seen[read].astype(np.int64)
+    start = images.time_seen[read]
+    end = np.where(np.isnan(images.time_done[read]), end_time, images.time_done[read])
+    if start_time > 0:
+        #reads that overlap start_time are cut at it, earlier ones dropped
+        keep = end > start_time
+        rad_id, start, end = rad_id[keep], np.maximum(start[keep], start_time), end[keep]
+    order = np.lexsort((start, rad_id))
+    rad_id, start, end = rad_id[order], start[order], end[order]
+    first = np.ones(len(start), dtype=bool)    #read that starts a new busy stretch
+    first[1:] = (rad_id[1:] != rad_id[:-1]) | (start[1:] > end[:-1])
+    busy_rad = rad_id[first]
+    busy_start = start[first]
+    busy_end = np.maximum.reduceat(end, np.flatnonzero(first)) if len(end) else end
+    #idle before each busy stretch, after the last one of each radiologist, and all along for radiologists that never read
+    same_rad = np.zeros(len(busy_rad), dtype=bool)
+    same_rad[1:] = busy_rad[1:] == busy_rad[:-1]
+    last = np.ones(len(busy_rad), dtype=bool)
+    last[:-1] = ~same_rad[1:]
+    never = np.setdiff1d(np.arange(num_rads), busy_rad)
+    rad_start = np.maximum(float(start_time), np.zeros(num_rads) if time_joined is None else np.asarray(time_joined, dtype=float))
+    idle_rad = np.concatenate([busy_rad, busy_rad[last], never])
+    idle_start = np.concatenate([np.where(same_rad, np.roll(busy_end, 1), rad_start[busy_rad]), busy_end[last], rad_start[never]])
+    idle_end = np.concatenate([busy_start, np.full(last.sum() + len(never), float(end_time))])
+    keep = idle_end > idle_start
+    table = pd.DataFrame({
+        'rad_id': np.concatenate([busy_rad, idle_rad[keep]]),
+        'start': np.concatenate([busy_start, idle_start[keep]]),
+        'end': np.concatenate([busy_end, idle_end[keep]]),
+        'busy': np.concatenate([np.ones(len(busy_rad), dtype=bool), np.zeros(keep.sum(), dtype=bool)]),
+    })
+    return table.sort_values(['rad_id', 'start'], kind='stable', ignore_index=True)
+
+
+class SimResult:
+    #The tables of a finished run, small enough to cache on disk in place of the whole SystemState
+    tables = ['img_table', 'unfin_img_table', 'intervals', 'queue_summary', 'sla']
+
+    def __init__(self, config, seed, time, img_table, unfin_img_table, intervals, queue_summary, sla, stopped_early=False):
+        self.config = config
+        self.seed = seed
+        self.time = time
+        self.img_table = img_table
+        self.unfin_img_table = unfin_img_table
+        self.intervals = intervals
+        self.queue_summary = queue_summary
+        self.sla = sla
+        self.stopped_early = stopped_early
+
+    @classmethod
+    def from_state(cls, s, seed=None):
+        return cls(s.config, seed, s.time, s.img_table, s.unfin_img_table, rad_intervals(s.images, len(s.rads), s.time, s.stats_start, [rad.time_joined for rad in s.rads]), s.queue_summary(),
+                   s.sla_counts(), s.stopped_early)
+
+    @property
+    def rads(self):
+        #stand-ins with the idle and busy lists of each radiologist, for the plots that take s.rads
+        rads = []
+        for rad_id in range(self.config.num_rads):
+            rows = self.intervals[self.intervals['rad_id'] == rad_id]
+            durations = (rows['end'] - rows['start']).values
+            busy = rows['busy'].values
+            rads.append(SimpleNamespace(rad_id=rad_id, idle_times=durations[~busy].tolist(), busy_times=durations[busy].tolist()))
+        return rads
+
+    def arrays(self):
+        #flat name -> array dict for np.savez, "table.column"
+        arrays = {'time': np.array(self.time), 'stopped_early': np.array(self.stopped_early)}
+        for name in self.tables:
+            table = getattr(self, name)
+            if name == 'queue_summary':
+                table = table.reset_index(names='rad_id').astype({'rad_id': str})
+            elif name == 'sla':
+                table = table.reset_index()
+            for col in table.columns:
+                values = table[col]
+                if values.dtype == 'Int64':
+                    values = values.fillna(-1).to_numpy(dtype=np.int64)
+                elif not pd.api.types.is_numeric_dtype(values):
+                    values = values.to_numpy(dtype=str)
+                arrays[f"{name}.{col}"] = np.asarray(values)
+        return arrays
+
+    @classmethod
+    def from_arrays(cls, config, seed, arrays):
+        tables = {name: {} for name in cls.tables}
+        for key in arrays.files:
+            if '.' in key:
+                name, col = key.split('.', 1)
+                tables[name][col] = arrays[key]
+        frames = {name: pd.DataFrame(columns) for name, columns in tables.items()}
+        for name in ('img_table', 'unfin_img_table'):
+            rad_id = pd.array(frames[name]['rad_id'], dtype="Int64")
+            rad_id[rad_id < 0] = pd.NA
+            frames[name]['rad_id'] = rad_id
+        summary = frames['queue_summary'].set_index('rad_id')
+        summary.index = [int(rad_id) if rad_id != 'system' else rad_id for rad_id in summary.index]
+        frames['queue_summary'] = summary
+        frames['sla'] = frames['sla'].set_index('urgency')
+        return cls(config, seed, float(arrays['time']), stopped_early=bool(arrays['stopped_early']), **frames)
+
+
+class ResultCache:
+    #Content addressed store of SimResults in directory path, one .npz per (config, seed, ENGINE_VERSION).
+    #Files are written to a temporary name and renamed into place, so other processes sharing the directory
+    #only ever see complete files. Reads refresh the file's mtime and the least recently used files are
+    #deleted once the directory grows past max_bytes
+    def __init__(self, path, max_bytes=256 * 2**20):
+        self.path = str(path)
+        self.max_bytes = max_bytes
+        os.makedirs(self.path, exist_ok=True)
+
+    def key(self, config, seed):
+        return config_hash(config, seed, ENGINE_VERSION)
+
+    def file(self, key):
+        return os.path.join(self.path, key + '.npz')
+
+    def get(self, config, seed):
+        file = self.file(self.key(config, seed))
+        try:
+            with np.load(file, allow_pickle=False) as arrays:
+                result = SimResult.from_arrays(config, seed, arrays)
+            os.utime(file)
+        except (OSError, ValueError, KeyError):
+            #missing, evicted by another process, or unreadable
+            return None
+        return result
+
+    def put(self, result):
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez_compressed(f, **result.arrays())
+            os.replace(tmp, self.file(self.key(result.config, result.seed)))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+        self.evict()
+
+    def evict(self):
+        files = []
+        for entry in os.scandir(self.path):
+            if entry.name.endswith('.npz'):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for mtime, size, file in files)
+        for mtime, size, file in sorted(files):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(file)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+
+def cached_run(config, seed, cache, verbose=False, progress=None):
+    #SimResult of config and seed from cache, running and storing it on a miss. A seed of None can't be
+    #reproduced so it is never cached
+    if seed is not None:
+        result = cache.get(config, seed)
+        if result is not None:
+            return result
+    result = SimResult.from_state(run_config(config, verbose, seed=seed, progress=progress), seed)
+    if seed is not None:
+        cache.put(result)
+    return result
+
+
 def plot_queue_lengths(s):
     fig, ax = plt.subplots()
-    for i in range(len(s.queue_lengths[0])):
-        plt.plot(s.time_steps, [item[i] for item in s.queue_lengths])
+    if len(s.queue_lengths) > 0:
+        for i in range(len(s.queue_lengths[0])):
+            plt.plot(s.time_steps, [item[i] for item in s.queue_lengths])
+        plt.xlabel("time")
+        plt.ylabel("Queue Length")
+    else:
+        #no trace was recorded, plot the time-weighted statistics instead
+        summary = s.queue_summary().drop('system')
+        plt.bar(summary.index, summary['mean'], yerr=np.sqrt(summary['var']), alpha=.6, label="mean")
+        plt.scatter(summary.index, summary['max'], color="red", label="max")
+        plt.xlabel("Radiologist ID")
+        plt.ylabel("Queue Length")
+        plt.legend()
 
         
 def wait_time_plot(img_table):
@@ -424,7 +1713,10 @@ def total_time_plot(img_table):
 def plt_mean_queue_length(s_list):
     fig, ax = plt.subplots()
     for s in s_list:
-        plt.plot(s.time_steps, pd.DataFrame(s.queue_lengths).sum(axis=1), label=f"{len(s.rads)}")
+        if len(s.queue_lengths) > 0:
+            plt.plot(s.time_steps, pd.DataFrame(s.queue_lengths).sum(axis=1), label=f"{len(s.rads)}")
+        else:
+            plt.hlines(s.queue_summary().loc['system', 'mean'], 0, s.time, label=f"{len(s.rads)}")
     plt.xlabel("time")
     plt.ylabel("Mean Queue Length")
     plt.legend()
@@ -446,43 +1738,29 @@ def rad_idle_plot(rad):
     plt.show()
     
     
-def idle_plots(rads):
-    plot_list = {}
-    total_idle = 0
-    total_busy = 0
-    avg_busy_times = {}
-    #idl_plt = plt.figure()
-    plt.figure(figsize = (13,10))
-    for rad in rads:
-        idle_times = rad.idle_times
-        busy_times = rad.busy_times
-        left_var = 0
-        for i in range(len(idle_times)):
-            plt.barh(rad.rad_id, idle_times[i], left=left_var, color="red")
-            left_var = left_var + idle_times[i]
-            if i < len(busy_times):
-                plt.barh(rad.rad_id, busy_times[i], left=left_var, color="orange")
-                left_var = left_var + busy_times[i]
-        per_busy = np.sum(busy_times)/(np.sum(busy_times) + np.sum(idle_times))
-        avg_busy_times[rad.rad_id] = per_busy
-        total_idle += np.sum(idle_times)
-        total_busy += np.sum(busy_times)
-        #print(f"Radiologist {rad.rad_id} was busy {round(per_busy, 3)} of the time.")
-        plt.legend(["idle", "busy"], title="Idle Times", loc="upper right")
-    plt.xlabel("time")
-    plt.ylabel("Radiologist ID")
-    plt.savefig('figures/idle_plot.jpg', dpi=100)
+def idle_plots(intervals):
+    #Plotly figures of the rad_intervals table, built in memory: every busy/idle stretch of every radiologist
+    #as one horizontal bar trace, and the ratio of time each one was busy. Returns (total_per_busy, idl_fig, busy_fig)
+    start = intervals['start'].values
+    duration = intervals['end'].values - start
+    busy = intervals['busy'].values
+    idl_fig = go.Figure(go.Bar(
+        base=start, x=duration, y=intervals['rad_id'].values, orientation='h',
+        marker_color=np.where(busy, "orange", "red"), marker_line_width=0,
+        customdata=np.column_stack([np.where(busy, "busy", "idle"), start]),
+        hovertemplate="Radiologist %{y} %{customdata[0]} from %{customdata[1]:.1f} for %{x:.1f} min<extra></extra>",
+    ))
+    idl_fig.update_layout(title="Busy (orange) vs Idle (red) Times for Radiologists", xaxis_title="time", yaxis_title="Radiologist ID",
+                          bargap=0.2, height=900)
     
-    total_per_busy = total_busy/(total_busy + total_idle)
+    busy_time = pd.Series(duration * busy).groupby(intervals['rad_id'].values).sum()
+    total_time = pd.Series(duration).groupby(intervals['rad_id'].values).sum()
+    total_per_busy = busy_time.sum() / total_time.sum() if total_time.sum() > 0 else 0
     # Busy percent plots
-    plt.figure(figsize = (10,10))
-    plt.bar(avg_busy_times.keys(), avg_busy_times.values())
-    plt.xlabel("Radiologist ID")
-    plt.ylabel("Ratio of Time Busy")
-    plt.savefig('figures/busy_plot.jpg', dpi=100)
-    #plt.show()
-    #print(f"Radiologists were busy {round(total_per_busy,3)} of the time.")
-    return total_per_busy#, plotly.tools.mpl_to_plotly(idl_plt)
+    busy_fig = go.Figure(go.Bar(x=busy_time.index, y=(busy_time / total_time).values))
+    busy_fig.update_layout(title="Ratio of Time Busy for Radiologists", xaxis_title="Radiologist ID", yaxis_title="Ratio of Time Busy",
+                           yaxis_range=[0, 1], height=600)
+    return total_per_busy, idl_fig, busy_fig
 
     
     